@@ -1,32 +0,0 @@
-import os, sys
-import logging
-from loki_logger_handler.loki_logger_handler import LokiLoggerHandler
-
-# Set up logging
-logger = logging.getLogger("custom_logger")
-logging_data = os.getenv("LOG_LEVEL", "INFO").upper()
-
-if logging_data == "DEBUG":
-    logger.setLevel(logging.DEBUG)
-else:
-    logger.setLevel(logging.INFO)
-
-# Create a console handler
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logger.level)
-formatter = logging.Formatter(
-    "%(levelname)s: %(asctime)s - %(name)s - %(message)s"
-)
-console_handler.setFormatter(formatter)
-
-# Create an instance of the custom handler
-loki_handler = LokiLoggerHandler(
-    url="http://loki:3100/loki/api/v1/push",
-    labels={"application": "FastApi"},
-    label_keys={},
-    timeout=10,
-)
-
-logger.addHandler(loki_handler)
-logger.addHandler(console_handler)
-logger.info("Logger initialized")
\ No newline at end of file
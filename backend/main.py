@@ -1,12 +1,25 @@
 import os
-import pytz
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from enum import Enum
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, Body, Query
+from functools import lru_cache, reduce, wraps
+from itertools import islice
+from math import prod
+from operator import sub, truediv
+from zoneinfo import ZoneInfo
+from fastapi import FastAPI, HTTPException, Body, Query, Request
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List
-from pymongo import MongoClient
-from prometheus_fastapi_instrumentator import Instrumentator 
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, field_validator
+from pydantic_core import PydanticCustomError
+from typing import Callable, Dict, List, Optional, Tuple
+from pymongo import MongoClient, InsertOne
+from prometheus_fastapi_instrumentator import Instrumentator, metrics
 from loki_logger_handler.loki_logger_handler import LokiLoggerHandler
 import sys
 import logging
@@ -46,15 +59,25 @@ logger.info("Logger initialized")
 # FASTAPI + CORS
 # ============================================================
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ensure_history_indexes(collection_historial)
+    history_writer.start()
+    yield
+    history_writer.stop()
+
+
 app = FastAPI(
     title="Calculator API - Project",
-    description="API para calculadora con historial en MongoDB, operaciones de N números y validaciones."
+    description="API para calculadora con historial en MongoDB, operaciones de N números y validaciones.",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  
-    allow_credentials=True,
+    allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -66,8 +89,37 @@ app.add_middleware(
 
 MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27020")
 
+# Índices para que get_history filtre y ordene sin sort en memoria
+HISTORY_INDEXES = [
+    [("operation", 1), ("date", -1)],
+    [("operation", 1), ("result", -1)],
+    [("date", -1)],
+]
+
+
+def ensure_history_indexes(collection):
+    # Fuera del try de conexión: si falla (permisos, índice en conflicto, timeout)
+    # solo se registra, sin cambiar la colección real por el mock
+    try:
+        for keys in HISTORY_INDEXES:
+            collection.create_index(keys)
+
+    except Exception as e:
+        logger.error("Error al crear índices del historial: %s", e)
+
+
 try:
-    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=5000)
+    client = MongoClient(
+        MONGO_URL,
+        serverSelectionTimeoutMS=5000,
+        maxPoolSize=50,
+        minPoolSize=10,
+        compressors="zstd,zlib",
+        socketTimeoutMS=2000,
+        connectTimeoutMS=2000,
+        retryWrites=True,
+        w=1,
+    )
     client.admin.command("ping")
     db = client.practica1
     collection_historial = db.historial
@@ -75,7 +127,7 @@ try:
     logger.info("Conexión exitosa a MongoDB.")
 
 except Exception as e:
-    logger.error(f"Error de conexión a MongoDB: {e}")
+    logger.error("Error de conexión a MongoDB: %s", e)
 
     # ---------- Mock Cursor ----------
     class MockCursor:
@@ -84,24 +136,135 @@ except Exception as e:
 
         def sort(self, *args, **kwargs):
             logger.warning("Usando MockCursor.sort() debido a falla en Mongo")
-            return self.data
+            return self
+
+        def skip(self, count):
+            return self
+
+        def limit(self, count):
+            return self
+
+        def __iter__(self):
+            return iter(self.data)
 
     # ---------- Mock Collection ----------
     class MockCollection:
         def insert_one(self, doc):
             logger.warning("MockCollection.insert_one() - El documento NO se guardó (Mongo desconectado)")
 
-        def find(self, query=None):
+        def find(self, query=None, projection=None):
             logger.warning("MockCollection.find() - Devolviendo cursor vacío")
             return MockCursor([])
 
+        def bulk_write(self, requests, ordered=True):
+            logger.warning("MockCollection.bulk_write() - Los documentos NO se guardaron (Mongo desconectado)")
+
         def delete_many(self, query=None):
             logger.warning("MockCollection.delete_many() - No se eliminó nada (Mongo desconectado)")
 
+        def create_index(self, keys):
+            logger.warning("MockCollection.create_index() - No se creó el índice (Mongo desconectado)")
+
     collection_historial = MockCollection()
 
 
 
+# ============================================================
+# HISTORY WRITER
+# ============================================================
+
+class HistoryWriter:
+    """Acumula documentos de historial y los escribe en lote con bulk_write.
+
+    El hilo de fondo vacía el buffer cada `flush_interval` segundos; al llegar a
+    `batch_size` documentos el flush se envía al pool "mongo-writer", así la
+    petición nunca espera a Mongo; solo hay un flush encolado a la vez. Arriba
+    de `max_pending` documentos se descartan con un warning. Las lecturas
+    llaman a flush() primero para ver las escrituras pendientes.
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 0.05, max_pending: int = 1000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._executor = self._new_executor()
+        self._buffer = []
+        self._flush_pending = False
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add(self, doc: dict):
+        self.add_many([doc])
+
+    def add_many(self, docs: List[dict]):
+        if not docs:
+            return
+
+        with self._buffer_lock:
+            free = max(self.max_pending - len(self._buffer), 0)
+            self._buffer.extend(docs[:free])
+            # Si Mongo se atora no se acumula un futuro por petición en el pool
+            submit = len(self._buffer) >= self.batch_size and not self._flush_pending
+            if submit:
+                self._flush_pending = True
+
+        if len(docs) > free:
+            logger.warning("Buffer de historial lleno: se descartaron %s documentos", len(docs) - free)
+
+        if submit:
+            self._executor.submit(self.flush)
+
+    def flush(self):
+        # Serializa los flush para que una lectura espere a la escritura en curso
+        with self._flush_lock:
+            with self._buffer_lock:
+                batch, self._buffer = self._buffer, []
+                self._flush_pending = False
+
+            if not batch:
+                return
+
+            try:
+                collection_historial.bulk_write([InsertOne(doc) for doc in batch], ordered=False)
+                logger.info("Historial guardado OK: %s documentos", len(batch))
+
+            except Exception as e:
+                logger.error("Error al guardar en historial: %s", e)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+        # Espera el flush encolado y deja un pool nuevo por si la app vuelve a arrancar
+        self._executor.shutdown(wait=True)
+        self._executor = self._new_executor()
+        self.flush()
+
+    @staticmethod
+    def _new_executor():
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongo-writer")
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+
+history_writer = HistoryWriter()
+
+
+
 # ============================================================
 # DATA MODELS
 # ============================================================
@@ -109,54 +272,187 @@ except Exception as e:
 class OperationData(BaseModel):
     numbers: List[float] = Field(..., min_length=2)
 
+    # Se valida en el mismo parseo del body; el handler de
+    # RequestValidationError lo convierte en el 400 de siempre
+    @field_validator("numbers")
+    @classmethod
+    def no_negatives(cls, numbers: List[float]) -> List[float]:
+        if min(numbers) < 0:
+            raise PydanticCustomError(
+                "negative_numbers", "Negative numbers are not allowed.", {"operands": numbers}
+            )
+        return numbers
+
 class BatchOperation(BaseModel):
     operation: str
     numbers: List[float] = Field(..., min_length=2)
 
+class OperationName(str, Enum):
+    sum = "sum"
+    subtract = "subtract"
+    multiplication = "multiplication"
+    division = "division"
+
+class SortField(str, Enum):
+    date = "date"
+    result = "result"
+
+class SortOrder(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+@dataclass(slots=True)
+class OpResult:
+    operation: str
+    numbers: List[float]
+    result: float
+
 
 
 # ============================================================
 # HELPERS
 # ============================================================
 
+TZ = ZoneInfo("America/Mexico_City")
+FMT = "%d/%m/%Y %H:%M"
+
+
 def get_datetime():
-    return datetime.now(pytz.timezone("America/Mexico_City"))
+    return datetime.now(TZ)
+
+
+def negative_numbers_detail(numbers: List[float], operation_name: str) -> dict:
+    logger.error("ERROR: Números negativos en operación %s -> %s", operation_name, numbers)
+    return {"error": "Negative numbers are not allowed.", "operation": operation_name, "operands": numbers}
 
 
 def validate_numbers(numbers: List[float], operation_name: str):
-    if any(num < 0 for num in numbers):
-        logger.error(f"ERROR: Números negativos en operación {operation_name} -> {numbers}")
-        raise HTTPException(
-            status_code=400,
-            detail={"error": "Negative numbers are not allowed.", "operation": operation_name, "operands": numbers}
-        )
+    if min(numbers) < 0:
+        raise HTTPException(status_code=400, detail=negative_numbers_detail(numbers, operation_name))
 
-    if operation_name == "division" and any(num == 0 for num in numbers[1:]):
-        logger.error(f"ERROR: División por cero en números {numbers}")
+    if operation_name == "division":
+        validate_divisors(numbers, operation_name)
+
+
+def validate_divisors(numbers: List[float], operation_name: str):
+    # 0.0 es falsy: all() recorre el divisor en C, sin copiar la lista
+    if not all(islice(numbers, 1, None)):
+        logger.error("ERROR: División por cero en números %s", numbers)
         raise HTTPException(
             status_code=403,
             detail={"error": "Division by zero is not allowed.", "operation": operation_name, "operands": numbers}
         )
 
 
+def build_history_doc(operation: str, numbers: List[float], result: float, now: datetime) -> dict:
+    return {
+        "operation": operation,
+        "numbers": numbers,
+        "result": result,
+        "date": now,
+        "formatted_date": now.strftime(FMT)
+    }
+
+
 def save_to_history(operation: str, numbers: List[float], result: float):
-    try:
-        now = get_datetime()
-        formatted_date = now.strftime("%d/%m/%Y %H:%M")
+    history_writer.add(build_history_doc(operation, numbers, result, get_datetime()))
+    logger.info("Historial encolado: %s %s = %s", operation, numbers, result)
 
-        doc = {
-            "operation": operation,
-            "numbers": numbers,
-            "result": result,
-            "date": now,
-            "formatted_date": formatted_date
-        }
 
-        collection_historial.insert_one(doc)
-        logger.info(f"Historial guardado OK: {operation} {numbers} = {result}")
+def format_history_doc(doc: dict, summary: bool = False) -> dict:
+    item = {
+        "result": doc.get("result", 0),
+        "operation": doc.get("operation", "unknown"),
+        "date": doc.get("formatted_date") or str(doc.get("date", "N/A"))
+    }
 
-    except Exception as e:
-        logger.error(f"Error al guardar en historial: {e}")
+    if not summary:
+        item["numbers"] = doc.get("numbers", [])
+
+    return item
+
+
+# Las operaciones son puras: entradas repetidas (reintentos, sondas) se
+# resuelven desde caché. El historial se sigue guardando en cada petición.
+OPERATION_CACHE_SIZE = 4096
+# Solo se memorizan listas cortas: con listas largas hashear la tupla cuesta lo
+# mismo que calcular, y cada entrada fijaría en memoria operandos del cliente
+OPERATION_CACHE_MAX_OPERANDS = 16
+
+
+def _cache_short_operands(func):
+    cached = lru_cache(maxsize=OPERATION_CACHE_SIZE)(func)
+
+    @wraps(func)
+    def wrapper(numbers: Tuple[float, ...]) -> float:
+        if len(numbers) <= OPERATION_CACHE_MAX_OPERANDS:
+            return cached(numbers)
+        return func(numbers)
+
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@_cache_short_operands
+def _sum_impl(numbers: Tuple[float, ...]) -> float:
+    return sum(numbers)
+
+
+@_cache_short_operands
+def _sub_impl(numbers: Tuple[float, ...]) -> float:
+    return reduce(sub, numbers)
+
+
+@_cache_short_operands
+def _mul_impl(numbers: Tuple[float, ...]) -> float:
+    return prod(numbers, start=1.0)
+
+
+@_cache_short_operands
+def _div_impl(numbers: Tuple[float, ...]) -> float:
+    return reduce(truediv, numbers)
+
+
+_OP_MAP: Dict[str, Tuple[str, Callable[[Tuple[float, ...]], float]]] = {
+    "sum": ("sum", _sum_impl),
+    "subtract": ("subtract", _sub_impl),
+    "multiplication": ("multiplication", _mul_impl),
+    "division": ("division", _div_impl),
+    "sub": ("subtract", _sub_impl),
+    "mul": ("multiplication", _mul_impl),
+    "div": ("division", _div_impl),
+}
+
+HISTORY_MAX_LIMIT = 1000
+
+# Solo los campos que usa get_history; el resumen omite el arreglo numbers
+HISTORY_PROJECTION = {"_id": 0, "numbers": 1, "result": 1, "operation": 1, "formatted_date": 1, "date": 1}
+HISTORY_SUMMARY_PROJECTION = {"_id": 0, "result": 1, "operation": 1, "formatted_date": 1, "date": 1}
+
+
+
+# ============================================================
+# EXCEPTION HANDLERS
+# ============================================================
+
+_ROUTE_OPS = {
+    "/calculator/sum": "sum",
+    "/calculator/subtract": "subtract",
+    "/calculator/multiply": "multiplication",
+    "/calculator/divide": "division",
+}
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    for error in exc.errors():
+        if error["type"] == "negative_numbers":
+            operation_name = _ROUTE_OPS.get(request.url.path, "unknown")
+            detail = negative_numbers_detail(error["ctx"]["operands"], operation_name)
+            return ORJSONResponse(status_code=400, content={"detail": detail})
+
+    return await request_validation_exception_handler(request, exc)
 
 
 
@@ -166,59 +462,47 @@ def save_to_history(operation: str, numbers: List[float], result: float):
 
 @app.post("/calculator/sum")
 def calculate_sum(data: OperationData = Body(...)):
-    logger.info(f"Solicitud suma: {data.numbers}")
-    validate_numbers(data.numbers, "sum")
+    logger.info("Solicitud suma: %s", data.numbers)
 
-    result = sum(data.numbers)
+    result = _sum_impl(tuple(data.numbers))
     save_to_history("sum", data.numbers, result)
 
     logger.info("Operación suma exitosa")
-    return {"operation": "sum", "numbers": data.numbers, "result": result}
+    return ORJSONResponse(OpResult("sum", data.numbers, result))
 
 
 
 @app.post("/calculator/subtract")
 def calculate_subtract(data: OperationData = Body(...)):
-    logger.info(f"Solicitud resta: {data.numbers}")
-    validate_numbers(data.numbers, "subtract")
-
-    result = data.numbers[0]
-    for num in data.numbers[1:]:
-        result -= num
+    logger.info("Solicitud resta: %s", data.numbers)
 
+    result = _sub_impl(tuple(data.numbers))
     save_to_history("subtract", data.numbers, result)
     logger.info("Operación resta exitosa")
-    return {"operation": "subtract", "numbers": data.numbers, "result": result}
+    return ORJSONResponse(OpResult("subtract", data.numbers, result))
 
 
 
 @app.post("/calculator/multiply")
 def calculate_multiply(data: OperationData = Body(...)):
-    logger.info(f"Solicitud multiplicación: {data.numbers}")
-    validate_numbers(data.numbers, "multiplication")
-
-    result = 1.0
-    for num in data.numbers:
-        result *= num
+    logger.info("Solicitud multiplicación: %s", data.numbers)
 
+    result = _mul_impl(tuple(data.numbers))
     save_to_history("multiplication", data.numbers, result)
     logger.info("Operación multiplicación exitosa")
-    return {"operation": "multiplication", "numbers": data.numbers, "result": result}
+    return ORJSONResponse(OpResult("multiplication", data.numbers, result))
 
 
 
 @app.post("/calculator/divide")
 def calculate_divide(data: OperationData = Body(...)):
-    logger.info(f"Solicitud división: {data.numbers}")
-    validate_numbers(data.numbers, "division")
-
-    result = data.numbers[0]
-    for num in data.numbers[1:]:
-        result /= num
+    logger.info("Solicitud división: %s", data.numbers)
+    validate_divisors(data.numbers, "division")
 
+    result = _div_impl(tuple(data.numbers))
     save_to_history("division", data.numbers, result)
     logger.info("Operación división exitosa")
-    return {"operation": "division", "numbers": data.numbers, "result": result}
+    return ORJSONResponse(OpResult("division", data.numbers, result))
 
 
 
@@ -227,81 +511,102 @@ def calculate_batch(operations: List[BatchOperation] = Body(...)):
     logger.info("Solicitud batch recibida")
 
     results = []
-    op_map = {
-        "sum": ("sum", calculate_sum),
-        "subtract": ("subtract", calculate_subtract),
-        "multiplication": ("multiplication", calculate_multiply),
-        "division": ("division", calculate_divide),
-        "sub": ("subtract", calculate_subtract),
-        "mul": ("multiplication", calculate_multiply),
-        "div": ("division", calculate_divide),
-    }
+    docs = []
+    now = get_datetime()
 
     for op in operations:
         op_type = op.operation.lower()
         numbers = op.numbers
 
-        if op_type not in op_map:
-            logger.error(f"Operación inválida en batch: {op_type}")
+        dispatch = _OP_MAP.get(op_type)
+
+        if dispatch is None:
+            logger.error("Operación inválida en batch: %s", op_type)
             results.append({"op": op_type, "error": "Invalid operation type.", "operands": numbers})
             continue
 
-        api_name, api_func = op_map[op_type]
+        api_name, impl = dispatch
 
         try:
-            op_data = OperationData(numbers=numbers)
-            result_doc = api_func(op_data)
-            results.append({"op": api_name, "result": result_doc["result"], "numbers": numbers})
+            validate_numbers(numbers, api_name)
+            result = impl(tuple(numbers))
+            results.append({"op": api_name, "result": result, "numbers": numbers})
+            docs.append(build_history_doc(api_name, numbers, result, now))
 
         except HTTPException as e:
-            logger.error(f"Error HTTP en batch: {e.detail}")
+            logger.error("Error HTTP en batch: %s", e.detail)
             results.append({"op": api_name, "error": e.detail["error"], "operands": e.detail["operands"]})
 
         except Exception as e:
-            logger.error(f"Error inesperado en batch: {e}")
-            error_message = "At least 2 numbers are required." if "min_length" in str(e) else str(e)
-            results.append({"op": api_name, "error": error_message, "operands": numbers})
+            logger.error("Error inesperado en batch: %s", e)
+            results.append({"op": api_name, "error": str(e), "operands": numbers})
 
+    history_writer.add_many(docs)
     logger.info("Batch finalizado")
-    return results
+    return ORJSONResponse(results)
 
 
 
 @app.get("/calculator/history")
 def get_history(
-    operation: str = Query(None),
-    sort_by: str = Query("date"),
-    sort_order: str = Query("desc")
+    operation: Optional[OperationName] = Query(None),
+    sort_by: SortField = Query(SortField.date),
+    sort_order: SortOrder = Query(SortOrder.desc),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(HISTORY_MAX_LIMIT, ge=1, le=HISTORY_MAX_LIMIT),
+    summary: bool = Query(False)
 ):
     try:
-        filter_query = {}
-        valid_ops = ["sum", "subtract", "multiplication", "division"]
+        filter_query = {} if operation is None else {"operation": operation.value}
 
-        if operation and operation.lower() in valid_ops:
-            filter_query["operation"] = operation.lower()
+        sort_direction = -1 if sort_order is SortOrder.desc else 1
+        sort_field = sort_by.value
 
-        sort_direction = -1 if sort_order == "desc" else 1
-        sort_field = "result" if sort_by == "result" else "date"
+        projection = HISTORY_SUMMARY_PROJECTION if summary else HISTORY_PROJECTION
 
-        ops = collection_historial.find(filter_query).sort([(sort_field, sort_direction)])
+        history_writer.flush()
+        ops = (
+            collection_historial.find(filter_query, projection=projection)
+            .sort([(sort_field, sort_direction)])
+            .skip(skip)
+            .limit(limit)
+        )
 
-        history = []
-        for operation_doc in ops:
-            formatted_date = operation_doc.get("formatted_date", str(operation_doc.get("date", "N/A")))
-            history.append({
-                "numbers": operation_doc.get("numbers", []),
-                "result": operation_doc.get("result", 0),
-                "operation": operation_doc.get("operation", "unknown"),
-                "date": formatted_date
-            })
+        history = [format_history_doc(operation_doc, summary) for operation_doc in ops]
 
         logger.info("Historial consultado correctamente")
         return {"history": history}
 
     except Exception as e:
-        logger.error(f"Error al obtener historial: {e}")
+        logger.error("Error al obtener historial: %s", e)
         raise HTTPException(status_code=500, detail="Error retrieving history")
 
 
-Instrumentator().instrument(app).expose(app)
+# Solo histogramas/contadores (sin los Summary de tamaño de request/response).
+# Los nombres coinciden con los que usa monitoring/import-dashboard.json.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+(
+    Instrumentator(should_group_status_codes=True, excluded_handlers=["/metrics"])
+    .add(metrics.requests())
+    .add(metrics.latency(should_include_status=False, buckets=LATENCY_BUCKETS))
+    .instrument(app)
+    .expose(app)
+)
+
 
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop/httptools cuando están instalados; sin access log (las métricas
+    # de Prometheus ya cuentan las peticiones)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        access_log=False,
+        log_config=None,
+    )
@@ -1,123 +1,250 @@
+import asyncio
+import math
+import httpx
+import orjson
 import pytest
-import mongomock
+import pytest_asyncio
+import threading
 from fastapi.testclient import TestClient
 from datetime import datetime
-import json
+from bson import ObjectId, decode, encode
+from bson.codec_options import CodecOptions
+from pymongo import InsertOne
 import main
 
 # ==================== TEST SETUP ====================
 
-client = TestClient(main.app)
+# ---------- Fake Collection ----------
+# Sustituto en memoria de la colección de Mongo con solo lo que usa main.py:
+# inserciones, find con filtro de igualdad, proyección, sort/skip/limit e índices.
 
-# Crear un cliente mock de MongoDB y sobrescribir el cliente real en main.py
-fake_mongo_client = mongomock.MongoClient()
-database = fake_mongo_client.practica1
-collection_historial = database.collection_historial
+def _matches(doc, query):
+    return all(doc.get(key) == value for key, value in query.items())
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    fields = [key for key, include in projection.items() if include and key != "_id"]
+    projected = {key: doc[key] for key in fields if key in doc}
+    if projection.get("_id", 1):
+        projected["_id"] = doc["_id"]
+    return projected
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, keys):
+        # Orden estable: se aplica de la última clave a la primera
+        for field, direction in reversed(keys):
+            self._docs.sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self._docs = self._docs[count:]
+        return self
+
+    def limit(self, count):
+        self._docs = self._docs[:count]
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+class FakeCollection:
+    def __init__(self):
+        self._docs = []
+        self._indexes = {"_id_": {"key": [("_id", 1)]}}
+
+    def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+            self._docs.append(dict(doc))
+
+    def bulk_write(self, requests, ordered=True):
+        # main.py solo envía InsertOne
+        self.insert_many([request._doc for request in requests], ordered=ordered)
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([_project(doc, projection) for doc in self._docs if _matches(doc, query or {})])
+
+    def count_documents(self, query):
+        return sum(1 for doc in self._docs if _matches(doc, query))
+
+    def create_index(self, keys):
+        name = "_".join(f"{field}_{direction}" for field, direction in keys)
+        self._indexes[name] = {"key": list(keys)}
+        return name
+
+    def index_information(self):
+        return self._indexes
+
+# Fecha fija en la zona horaria de MX para que los documentos guardados sean estables
+_FIXED_TIME = datetime(2025, 10, 2, 10, 30, 0, 0, tzinfo=main.TZ)
+_FIXED_GETTER = lambda: _FIXED_TIME
+
+@pytest.fixture(scope="session")
+def client():
+    """Un solo TestClient para toda la sesión, con las rutas ya calentadas."""
+    client = TestClient(main.app)
+    # Primera petición a cada ruta sin guardar historial: 422 en sum, lote vacío
+    # y una lectura contra una colección falsa en lugar de la real
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(main, "collection_historial", FakeCollection())
+        client.post("/calculator/sum", json={"numbers": [1]})
+        client.post("/calculator/batch", json=[])
+        client.get("/calculator/history")
+    return client
+
+@pytest.fixture
+def collection_historial(request):
+    """Colección falsa en memoria: vacía en cada prueba, o el historial poblado con readonly_history."""
+    if request.node.get_closest_marker("readonly_history"):
+        return request.getfixturevalue("populated_history")
+    return FakeCollection()
+
+@pytest_asyncio.fixture(scope="session")
+async def aclient():
+    """Cliente httpx asíncrono sobre la app ASGI, para lanzar peticiones concurrentes."""
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as c:
+        yield c
 
 # Configuración del mock antes de cada prueba
 @pytest.fixture(autouse=True)
-def setup_teardown(monkeypatch):
-    """Garantiza que el mock se use en main y limpia la colección antes de cada prueba."""
+def setup_teardown(monkeypatch, collection_historial):
+    """Garantiza que el mock (una colección nueva por prueba) se use en main."""
     monkeypatch.setattr(main, "collection_historial", collection_historial)
-    collection_historial.delete_many({})
-    # Mocks para asegurar que las fechas sean estables y usar la zona horaria de MX
-    mexico_tz = main.pytz.timezone('America/Mexico_City')
-    fixed_time = datetime(2025, 10, 2, 10, 30, 0, 0, tzinfo=mexico_tz)
-    monkeypatch.setattr(main, "get_datetime", lambda: fixed_time)
+    monkeypatch.setattr(main, "get_datetime", _FIXED_GETTER)
+    yield
+    main.history_writer.flush() # Vaciar escrituras pendientes en la colección de esta prueba
+
+@pytest.fixture
+def no_history(collection_historial):
+    """Comprueba que las rutas de error no dejan nada en el historial."""
     yield
-    collection_historial.delete_many({}) # Limpiar después
+    main.history_writer.flush()
+    assert collection_historial.count_documents({}) == 0
 
 # ==================== AUXILIARES ====================
 
-def post_operation(endpoint, numbers):
-    """Auxiliar para ejecutar peticiones POST con body JSON."""
+_JSON_HEADERS = {"content-type": "application/json"}
+
+def post_operation(client, endpoint, numbers):
+    """Auxiliar para ejecutar peticiones POST con body JSON (serializado con orjson)."""
     return client.post(
         f"/calculator/{endpoint}",
-        json={"numbers": numbers}
+        content=orjson.dumps({"numbers": numbers}),
+        headers=_JSON_HEADERS
+    )
+
+def json_body(response, status_code=200):
+    """Comprueba el status antes de parsear, para no decodificar cuerpos de una respuesta inesperada."""
+    assert response.status_code == status_code, response.text
+    return response.json()
+
+def post_batch(client, body):
+    """Auxiliar para enviar un lote ya serializado a /calculator/batch."""
+    return client.post("/calculator/batch", content=body, headers=_JSON_HEADERS)
+
+async def apost_operation(aclient, endpoint, numbers):
+    """Versión asíncrona de post_operation."""
+    return await aclient.post(
+        f"/calculator/{endpoint}",
+        content=orjson.dumps({"numbers": numbers}),
+        headers=_JSON_HEADERS
     )
 
 # ==================== PRUEBAS DE OPERACIONES (N NÚMEROS Y POST) ====================
 
-@pytest.mark.parametrize(
-    "numbers, expected_result",
-    [
-        ([10, 5, 5], 20),
-        ([1.5, 2.5, 3.0, 3.0], 10.0),
-    ]
-)
-def test_sum_n_numbers(numbers, expected_result):
-    response = post_operation("sum", numbers)
-    assert response.status_code == 200
-    assert abs(response.json()["result"] - expected_result) < 0.01
+# (endpoint, numbers, expected, exact): los operandos enteros dan resultados exactos;
+# solo los casos con decimales se comparan con tolerancia
+_ARITHMETIC_CASES = [
+    ("sum", [10, 5, 5], 20, True),
+    ("sum", [1.5, 2.5, 3.0, 3.0], 10.0, False),
+    ("subtract", [10, 3, 2, 1], 4, True), # 10 - 3 - 2 - 1 = 4
+    ("subtract", [100, 20, 30], 50, True),
+    ("multiply", [2, 3, 4, 1], 24, True), # 2 * 3 * 4 * 1 = 24
+    ("multiply", [5, 2.5, 2], 25.0, False),
+    ("divide", [100, 2, 5], 10.0, True), # 100 / 2 / 5 = 10
+    ("divide", [120, 3, 4, 2], 5.0, True),
+]
 
-@pytest.mark.parametrize(
-    "numbers, expected_result",
-    [
-        ([10, 3, 2, 1], 4), # 10 - 3 - 2 - 1 = 4
-        ([100, 20, 30], 50),
-    ]
-)
-def test_subtract_n_numbers(numbers, expected_result):
-    response = post_operation("subtract", numbers)
-    assert response.status_code == 200
-    assert abs(response.json()["result"] - expected_result) < 0.01
+@pytest.mark.asyncio
+async def test_arithmetic_concurrent(aclient):
+    """Test para las cuatro operaciones con N números, enviando todas las peticiones en paralelo."""
+    responses = await asyncio.gather(
+        *(apost_operation(aclient, endpoint, numbers) for endpoint, numbers, _, _ in _ARITHMETIC_CASES)
+    )
 
-@pytest.mark.parametrize(
-    "numbers, expected_result",
-    [
-        ([2, 3, 4, 1], 24), # 2 * 3 * 4 * 1 = 24
-        ([5, 2.5, 2], 25.0),
-    ]
-)
-def test_multiply_n_numbers(numbers, expected_result):
-    response = post_operation("multiply", numbers)
-    assert response.status_code == 200
-    assert abs(response.json()["result"] - expected_result) < 0.01
+    for (endpoint, numbers, expected, exact), response in zip(_ARITHMETIC_CASES, responses):
+        assert response.status_code == 200, (endpoint, numbers)
+        result = response.json()["result"]
+        if exact:
+            assert result == expected, (endpoint, numbers)
+        else:
+            assert math.isclose(result, expected, abs_tol=0.01), (endpoint, numbers)
 
-@pytest.mark.parametrize(
-    "numbers, expected_result",
-    [
-        ([100, 2, 5], 10.0), # 100 / 2 / 5 = 10
-        ([120, 3, 4, 2], 5.0), 
-    ]
-)
-def test_divide_n_numbers(numbers, expected_result):
-    response = post_operation("divide", numbers)
+def test_operation_response_shape(client):
+    """Test que la respuesta serializada del dataclass conserva operación, operandos y resultado."""
+    response = post_operation(client, "multiply", [2, 3])
     assert response.status_code == 200
-    assert abs(response.json()["result"] - expected_result) < 0.01
+    assert response.json() == {"operation": "multiplication", "numbers": [2.0, 3.0], "result": 6.0}
 
 # ==================== PRUEBAS DE VALIDACIÓN ====================
 
-def test_divide_by_zero_error():
+@pytest.mark.usefixtures("no_history")
+def test_divide_by_zero_error(client):
     """Test para división entre cero (Status 403)."""
-    response = post_operation("divide", [10, 2, 0, 5])
+    response = post_operation(client, "divide", [10, 2, 0, 5])
     assert response.status_code == 403
     assert "Division by zero is not allowed" in response.json()["detail"]["error"]
 
-def test_negative_numbers_error():
+@pytest.mark.usefixtures("no_history")
+def test_negative_numbers_error(client):
     """Test para números negativos (Status 400)."""
-    response = post_operation("multiply", [5, -3, 2])
+    response = post_operation(client, "multiply", [5, -3, 2])
     assert response.status_code == 400
-    assert "Negative numbers are not allowed" in response.json()["detail"]["error"]
-    assert response.json()["detail"]["operation"] == "multiplication"
 
-def test_insufficient_numbers_error():
+    detail = response.json()["detail"]
+    assert "Negative numbers are not allowed" in detail["error"]
+    assert detail["operation"] == "multiplication"
+    assert detail["operands"] == [5.0, -3.0, 2.0]
+
+@pytest.mark.usefixtures("no_history")
+def test_negative_numbers_error_on_divide(client):
+    """Test que el 400 por negativos también aplica en división, antes de revisar ceros."""
+    response = post_operation(client, "divide", [-10, 0])
+    assert response.status_code == 400
+    assert response.json()["detail"]["operation"] == "division"
+
+@pytest.mark.usefixtures("no_history")
+def test_insufficient_numbers_error(client):
     """Test para menos de 2 números (Error Pydantic 422)."""
-    response = post_operation("sum", [5])
+    response = post_operation(client, "sum", [5])
     assert response.status_code == 422 
     
 # ==================== PRUEBAS DE OPERACIONES POR LOTE ====================
 
-def test_batch_operations_success_and_error():
+# Cuerpos de lote serializados una sola vez al importar
+_BATCH_SUCCESS_AND_ERROR = orjson.dumps([
+    {"operation": "sum", "numbers": [1, 2, 3]},       # 6 (Success)
+    {"operation": "div", "numbers": [100, 0, 5]},      # Division by zero (Error 403)
+    {"operation": "mul", "numbers": [2, 4]},           # 8 (Success)
+    {"operation": "sub", "numbers": [5, -3]},          # Negative error (Error 400)
+])
+_BATCH_INVALID_OPERATION = orjson.dumps([
+    {"operation": "mod", "numbers": [5, 2]},
+    {"operation": "sum", "numbers": [5, 2]},
+])
+_BATCH_HISTORY_TRACKING = orjson.dumps([
+    {"operation": "sum", "numbers": [1, 1]},        # Success
+    {"operation": "div", "numbers": [5, 0]},        # Error (No se guarda)
+    {"operation": "mul", "numbers": [2, 5]},        # Success
+])
+
+def test_batch_operations_success_and_error(client):
     """Tests para lote con operaciones exitosas y errores controlados."""
-    batch_request = [
-        {"operation": "sum", "numbers": [1, 2, 3]},       # 6 (Success)
-        {"operation": "div", "numbers": [100, 0, 5]},      # Division by zero (Error 403)
-        {"operation": "mul", "numbers": [2, 4]},           # 8 (Success)
-        {"operation": "sub", "numbers": [5, -3]},          # Negative error (Error 400)
-    ]
-    
-    response = client.post("/calculator/batch", json=batch_request)
+    response = post_batch(client, _BATCH_SUCCESS_AND_ERROR)
     
     assert response.status_code == 200 
     results = response.json()
@@ -140,17 +267,18 @@ def test_batch_operations_success_and_error():
     assert results[3]["op"] == "subtract"
     assert "Negative numbers are not allowed" in results[3]["error"]
 
-def test_batch_history_tracking():
+def test_batch_invalid_operation(client):
+    """Test para una operación desconocida en el lote: error por elemento, sin afectar a las demás."""
+    results = json_body(post_batch(client, _BATCH_INVALID_OPERATION))
+
+    assert results[0] == {"op": "mod", "error": "Invalid operation type.", "operands": [5.0, 2.0]}
+    assert results[1]["result"] == 7
+
+def test_batch_history_tracking(client):
     """Tests que solo las operaciones exitosas en lote se guardan en historial, independientemente del orden."""
-    batch_request = [
-        {"operation": "sum", "numbers": [1, 1]},        # Success
-        {"operation": "div", "numbers": [5, 0]},        # Error (No se guarda)
-        {"operation": "mul", "numbers": [2, 5]},        # Success
-    ]
-    
-    client.post("/calculator/batch", json=batch_request)
+    assert post_batch(client, _BATCH_HISTORY_TRACKING).status_code == 200
     
-    history = client.get("/calculator/history").json()["history"]
+    history = json_body(client.get("/calculator/history"))["history"]
     
     # 1. Verificar que solo se guardaron las 2 operaciones exitosas
     assert len(history) == 2
@@ -160,47 +288,170 @@ def test_batch_history_tracking():
     assert "sum" in operations_found
     assert "multiplication" in operations_found
 
+def test_history_writer_flushes_on_batch_size(client, monkeypatch, collection_historial):
+    """Test que el escritor de historial hace bulk_write al llenar el lote, sin esperar una lectura."""
+    monkeypatch.setattr(main.history_writer, "batch_size", 3)
+
+    post_operation(client, "sum", [1, 1])
+    post_operation(client, "sum", [2, 2])
+    assert collection_historial.count_documents({}) == 0
+
+    post_operation(client, "sum", [3, 3])
+    main.history_writer._executor.submit(lambda: None).result() # Esperar el flush enviado al pool
+    assert collection_historial.count_documents({}) == 3
+
+def test_history_writer_queues_one_flush_at_a_time(client, monkeypatch, collection_historial):
+    """Test que con el pool ocupado solo se encola un flush por tamaño, no uno por petición."""
+    writer = main.history_writer
+    monkeypatch.setattr(writer, "batch_size", 1)
+    flushes = []
+    flush = writer.flush
+    monkeypatch.setattr(writer, "flush", lambda: flushes.append(1) or flush())
+
+    release = threading.Event()
+    writer._executor.submit(release.wait) # Simula un bulk_write atorado
+    try:
+        for numbers in ([1, 1], [2, 2], [3, 3]):
+            assert post_operation(client, "sum", numbers).status_code == 200
+    finally:
+        release.set()
+
+    writer._executor.submit(lambda: None).result()
+    assert len(flushes) == 1
+    assert collection_historial.count_documents({}) == 3
+
+def test_history_writer_restarts_after_stop(collection_historial):
+    """Test que el writer sigue enviando flushes al pool después de un ciclo start/stop."""
+    writer = main.HistoryWriter(batch_size=1)
+    writer.start()
+    writer.stop()
+
+    writer.start()
+    writer.add({"operation": "sum", "numbers": [1, 1], "result": 2})
+    writer._executor.submit(lambda: None).result()
+    writer.stop()
+
+    assert collection_historial.count_documents({}) == 1
+
+def test_history_writer_drops_docs_when_buffer_is_full(client, monkeypatch):
+    """Test que el buffer de historial está acotado y descarta lo que no cabe."""
+    monkeypatch.setattr(main.history_writer, "max_pending", 2)
+
+    for numbers in ([1, 1], [2, 2], [3, 3]):
+        assert post_operation(client, "sum", numbers).status_code == 200
+
+    history = json_body(client.get("/calculator/history"))["history"]
+    assert len(history) == 2
+
+def test_repeated_operation_is_cached_but_still_saved(client):
+    """Test que una operación repetida se resuelve desde caché pero se guarda cada vez en el historial."""
+    main._sum_impl.cache_clear()
+
+    first = post_operation(client, "sum", [4, 4])
+    second = post_operation(client, "sum", [4, 4])
+
+    assert json_body(first)["result"] == json_body(second)["result"] == 8
+    assert main._sum_impl.cache_info().hits == 1
+
+    history = json_body(client.get("/calculator/history"))["history"]
+    assert len(history) == 2
+
+def test_long_operand_lists_are_not_cached(client):
+    """Test que las listas largas se calculan sin guardarse en la caché."""
+    main._sum_impl.cache_clear()
+    numbers = [1] * (main.OPERATION_CACHE_MAX_OPERANDS + 1)
+
+    assert json_body(post_operation(client, "sum", numbers))["result"] == len(numbers)
+    assert main._sum_impl.cache_info().currsize == 0
+
+def test_metrics_exposed_without_size_summaries(client):
+    """Test que /metrics expone el contador y el histograma de latencia, sin los Summary de tamaño."""
+    post_operation(client, "sum", [1, 2])
+    body = client.get("/metrics").text
+
+    assert "http_requests_total" in body
+    assert 'http_request_duration_seconds_bucket{handler="/calculator/sum",le="0.1",method="POST"}' in body
+    assert "http_request_size_bytes" not in body
+    assert 'handler="/metrics"' not in body
+
 # ==================== PRUEBAS DE HISTORIAL AVANZADO ====================
 
-@pytest.fixture
-def populated_history(setup_teardown):
-    """Fixture para poblar el historial mock con datos diversos para probar filtros y ordenamiento."""
-    
-    # Las fechas son cruciales para el orden: 10:00 (result 10), 11:00 (result 20), 12:00 (result 5), 09:00 del día siguiente (result 100)
-    mexico_tz = main.pytz.timezone('America/Mexico_City')
-    data = [
-        {"operation": "sum", "numbers": [1, 9], "result": 10, "date": datetime(2025, 10, 2, 10, 0, tzinfo=mexico_tz)}, 
-        {"operation": "divide", "numbers": [10, 2], "result": 5, "date": datetime(2025, 10, 2, 12, 0, tzinfo=mexico_tz)}, 
-        {"operation": "sum", "numbers": [10, 10], "result": 20, "date": datetime(2025, 10, 2, 11, 0, tzinfo=mexico_tz)}, 
-        {"operation": "multiplication", "numbers": [10, 10], "result": 100, "date": datetime(2025, 10, 3, 9, 0, tzinfo=mexico_tz)}, 
-    ]
-    # Simular el guardado en la base de datos real (incluyendo el campo 'date' para el sort)
-    for doc in data:
-        doc["formatted_date"] = doc["date"].strftime('%d/%m/%Y %H:%M')
-    collection_historial.insert_many(data)
-    
-    return collection_historial
+# Las fechas son cruciales para el orden: 10:00 (result 10), 11:00 (result 20), 12:00 (result 5), 09:00 del día siguiente (result 100)
+_POPULATED_DATA = [
+    {"operation": "sum", "numbers": [1, 9], "result": 10, "date": datetime(2025, 10, 2, 10, 0, tzinfo=main.TZ), "formatted_date": "02/10/2025 10:00"},
+    {"operation": "divide", "numbers": [10, 2], "result": 5, "date": datetime(2025, 10, 2, 12, 0, tzinfo=main.TZ), "formatted_date": "02/10/2025 12:00"},
+    {"operation": "sum", "numbers": [10, 10], "result": 20, "date": datetime(2025, 10, 2, 11, 0, tzinfo=main.TZ), "formatted_date": "02/10/2025 11:00"},
+    {"operation": "multiplication", "numbers": [10, 10], "result": 100, "date": datetime(2025, 10, 3, 9, 0, tzinfo=main.TZ), "formatted_date": "03/10/2025 09:00"},
+]
 
-def test_history_filter_and_sort(populated_history):
-    """Test para filtrar por tipo de operación y ordenar por resultado descendente."""
-    # Filtrar por "sum" y ordenar por "result" descendente
-    response = client.get("/calculator/history?operation=sum&sort_by=result&sort_order=desc")
-    history = response.json()["history"]
-    
+# Codificados a BSON una sola vez; cada prueba decodifica copias nuevas
+_POPULATED_BSON = [encode(doc) for doc in _POPULATED_DATA]
+_CODEC_OPTIONS = CodecOptions(tz_aware=True, tzinfo=main.TZ)
+
+@pytest.fixture(scope="module")
+def populated_history():
+    """Fixture para poblar el historial falso con datos diversos para probar filtros y ordenamiento.
+
+    Se llena una sola vez por módulo; las pruebas que la usan llevan la marca
+    readonly_history y no deben escribir en ella.
+    """
+    collection = FakeCollection()
+    collection.bulk_write(
+        [InsertOne(decode(raw, codec_options=_CODEC_OPTIONS)) for raw in _POPULATED_BSON],
+        ordered=False
+    )
+    # Mismos índices que main crea en producción para las consultas de get_history
+    main.ensure_history_indexes(collection)
+    return collection
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        # Filtrar por "sum" y ordenar por "result" descendente
+        ("operation=sum&sort_by=result&sort_order=desc", [("sum", 20), ("sum", 10)]),
+        # Orden por fecha: 10:00, 11:00, 12:00 (Oct 2), 09:00 (Oct 3)
+        ("sort_by=date&sort_order=asc", [("sum", 10), ("sum", 20), ("divide", 5), ("multiplication", 100)]),
+        # Paginación con skip y limit sobre el orden por fecha
+        ("sort_by=date&sort_order=asc&skip=1&limit=2", [("sum", 20), ("divide", 5)]),
+    ],
+    ids=["filter_sum_sort_result_desc", "sort_date_asc", "paginate_date_asc"],
+)
+@pytest.mark.readonly_history
+def test_history_query(client, query, expected):
+    """Test para filtros, ordenamiento y paginación del historial: una sola petición por caso."""
+    response = client.get(f"/calculator/history?{query}")
     assert response.status_code == 200
-    assert len(history) == 2
-    assert history[0]["result"] == 20 # Mayor resultado de la suma
-    assert history[1]["result"] == 10
-    assert all(item["operation"] == "sum" for item in history)
-    
-def test_history_sort_by_date_asc(populated_history):
-    """Test para ordenar por fecha ascendente (el más antiguo primero)."""
-    response = client.get("/calculator/history?sort_by=date&sort_order=asc")
+
     history = response.json()["history"]
-    
-    assert response.status_code == 200
-    # Orden por fecha: 10:00, 11:00, 12:00 (Oct 2), 09:00 (Oct 3)
-    assert history[0]["result"] == 10
-    assert history[1]["result"] == 20
-    assert history[2]["result"] == 5
-    assert history[3]["result"] == 100
\ No newline at end of file
+    assert [(item["operation"], item["result"]) for item in history] == expected
+
+def test_history_index_failure_is_logged(caplog):
+    """Test que un error al crear índices solo se registra y no se propaga."""
+    class FailingCollection:
+        def create_index(self, keys):
+            raise RuntimeError("not authorized")
+
+    with caplog.at_level("ERROR", logger="custom_logger"):
+        main.ensure_history_indexes(FailingCollection())
+
+    assert "not authorized" in caplog.text
+
+def test_history_limit_out_of_range(client):
+    """Test para un limit mayor al máximo permitido (Error de validación 422)."""
+    response = client.get(f"/calculator/history?limit={main.HISTORY_MAX_LIMIT + 1}")
+    assert response.status_code == 422
+
+@pytest.mark.readonly_history
+def test_history_summary_omits_numbers(client):
+    """Test para el modo resumen: el historial no incluye los operandos."""
+    history = json_body(client.get("/calculator/history?operation=sum&summary=true"))["history"]
+
+    assert len(history) == 2
+    assert all("numbers" not in item for item in history)
+    assert all(item["date"] for item in history)
+
+def test_history_invalid_query_params(client):
+    """Test para parámetros de historial fuera de los valores permitidos (Error de validación 422)."""
+    assert client.get("/calculator/history?operation=modulo").status_code == 422
+    assert client.get("/calculator/history?sort_by=numbers").status_code == 422
+    assert client.get("/calculator/history?sort_order=up").status_code == 422